@@ -59,10 +59,20 @@ class Checkpointer:
         return jax.tree_util.tree_map(ocp.utils.to_shape_dtype_struct, tree)
 
     def save_checkpoint(
-        self, model: eqx.Module, model_config: LlamaConfig, step: int = 0
+        self,
+        model_params: PyTree,
+        model_static: PyTree,
+        model_config: LlamaConfig,
+        step: int = 0,
     ):
-        """Saves model checkpoint."""
-        model_pytree, _ = eqx.partition(model, eqx.is_inexact_array)
+        """Saves model checkpoint from a partitioned (params, static) pair.
+
+        Takes the partitioned representation directly so callers in the
+        training loop don't have to combine the full model just to save;
+        only the inexact array leaves are serialized anyway.
+        """
+        del model_static  # Only array leaves are serialized.
+        model_pytree = eqx.filter(model_params, eqx.is_inexact_array)
         self.checkpoint_mgr.save(
             step=step,
             args=ocp.args.Composite(
@@ -25,6 +25,9 @@ class DatasetConfig:
     batch_size: int = 32
     max_seq_length: int = 64
     num_workers: int = 4
+    # Opt-in: page-locked buffers speed up H2D copies on CUDA hosts, but
+    # torch just warns on CPU/TPU-only builds (like the pinned CPU wheel).
+    pin_memory: bool = False
     ignore_index: int = -100
     prompt_style: Union[str, BasePromptTemplate] = "alpaca"
     mask_prompt: bool = False
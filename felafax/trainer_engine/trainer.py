@@ -1,16 +1,26 @@
 from dataclasses import dataclass
 from typing import Optional, Any
 import functools
+import itertools
 import pyrallis
 import jax
 # jax.distributed.initialize()
 
 import equinox as eqx
 import quax
+import torch
 import jax.numpy as jnp
 from jax.experimental import mesh_utils
 from jax.sharding import NamedSharding, PartitionSpec as PS
 
+try:
+    # Private fast-path APIs; fall back to jnp.asarray if they move.
+    from jax.core import ShapedArray
+    from jax._src.lib import xla_client as xc
+except ImportError:  # pragma: no cover
+    ShapedArray = None
+    xc = None
+
 import optax
 
 from felafax.trainer_engine.checkpoint import (
@@ -22,40 +32,114 @@ from felafax.trainer_engine.checkpoint import (
 import os
 
 
-def get_mesh(num_tpus: int):
-    mesh_shape = None
-    if num_tpus == 4:
-        mesh_shape = (1, 2, 2)
-    elif num_tpus == 8:
-        mesh_shape = (2, 2, 2)
+def get_mesh(
+    num_tpus: int,
+    ici_mesh_shape: Optional[tuple] = None,
+    dcn_mesh_shape: Optional[tuple] = None,
+):
+    """Creates the (batch, fsdp, mp) device mesh.
+
+    For multi-slice pods, pass ici_mesh_shape (within a slice) and
+    dcn_mesh_shape (across slices). The mp axis is innermost so
+    model-parallel all-reduces stay on the fast ICI links, while the
+    outermost batch axis crosses the slower DCN links only for
+    data-parallel gradient syncs.
+    """
+    if ici_mesh_shape is not None or dcn_mesh_shape is not None:
+        ici_mesh_shape = ici_mesh_shape or (1, 1, 1)
+        dcn_mesh_shape = dcn_mesh_shape or (1, 1, 1)
+        print(
+            f"Creating hybrid TPU device mesh with ICI shape {ici_mesh_shape} "
+            f"and DCN shape {dcn_mesh_shape}..."
+        )
+        device_mesh = mesh_utils.create_hybrid_device_mesh(
+            ici_mesh_shape, dcn_mesh_shape
+        )
     else:
-        raise ValueError(f"Invalid number of TPUs: {num_tpus}")
-
-    print(f"Creating TPU device mesh with shape {mesh_shape}...")
-    device_mesh = mesh_utils.create_device_mesh(mesh_shape)
+        mesh_shape = None
+        if num_tpus == 4:
+            mesh_shape = (1, 2, 2)
+        elif num_tpus == 8:
+            mesh_shape = (2, 2, 2)
+        else:
+            raise ValueError(f"Invalid number of TPUs: {num_tpus}")
+
+        print(f"Creating TPU device mesh with shape {mesh_shape}...")
+        device_mesh = mesh_utils.create_device_mesh(mesh_shape)
     mesh = jax.sharding.Mesh(
         device_mesh, axis_names=("batch", "fsdp", "mp")
     )
     return mesh
 
 
+@functools.lru_cache(maxsize=None)
+def _default_device_sharding():
+    # Built once; batched_device_put caches on sharding identity.
+    return jax.sharding.SingleDeviceSharding(jax.devices()[0])
+
+
+def _to_jax_array(v):
+    """Converts one tensor to a JAX array without extra host copies.
+
+    GPU torch tensors hand over zero-copy via dlpack; host tensors use
+    the batched_device_put fast path (use pin_memory=True dataloaders
+    on CUDA hosts for async copies).
+    """
+    if isinstance(v, jax.Array):
+        return v
+    if isinstance(v, torch.Tensor):
+        if v.device.type != "cpu":
+            return jax.dlpack.from_dlpack(v)
+        v = v.numpy()
+    if xc is None:
+        return jnp.asarray(v)
+    sharding = _default_device_sharding()
+    aval = ShapedArray(v.shape, jax.dtypes.canonicalize_dtype(v.dtype))
+    v = v.astype(aval.dtype, copy=False)
+    return xc.batched_device_put(
+        aval, sharding, [v], list(sharding.device_set), committed=True
+    )
+
+
 def _preprocess_batch(batch):
-    # Convert PyTorch tensors to JAX arrays
-    batch = {
-        k: v if isinstance(v, jax.Array) else jax.numpy.array(v.numpy())
-        for k, v in batch.items()
-    }
-    batch["input_ids"] = batch["input_ids"].astype(jnp.int32)
-    batch["labels"] = batch["labels"].astype(jnp.int32)
-
-    # Add position IDs to batch
-    seq_length = batch["input_ids"].shape[1]
-    batch["position_ids"] = jnp.repeat(
-        jnp.arange(seq_length)[None, :],
-        batch["input_ids"].shape[0],
-        axis=0,
+    # Convert to JAX arrays in one tree traversal; torch tensors are not
+    # pytree leaves, so any non-container counts as a leaf. int32 casts
+    # and position_ids happen inside the jitted forward.
+    return jax.tree_util.tree_map(
+        _to_jax_array,
+        batch,
+        is_leaf=lambda x: not isinstance(x, (dict, list, tuple)),
     )
-    return batch
+
+
+def _optimizer_state_sharding(opt_state, mesh):
+    """Shards opt-state array leaves along fsdp (ZeRO-1); scalars and
+    non-divisible leaves stay replicated."""
+    fsdp_size = mesh.shape["fsdp"]
+
+    def _leaf_sharding(x):
+        if eqx.is_array(x) and x.ndim > 0 and x.shape[0] % fsdp_size == 0:
+            return NamedSharding(mesh, PS("fsdp"))
+        return NamedSharding(mesh, PS())
+
+    return jax.tree_util.tree_map(_leaf_sharding, opt_state)
+
+
+def _one_batch_ahead_iterator(dataloader, sharding):
+    """Yields device-resident batches one transfer ahead of consumption,
+    overlapping the async host-to-device copy with the current step."""
+    iterator = iter(dataloader)
+    try:
+        next_batch = jax.device_put(
+            _preprocess_batch(next(iterator)), sharding
+        )
+    except StopIteration:
+        return
+    for batch in iterator:
+        batch = jax.device_put(_preprocess_batch(batch), sharding)
+        yield next_batch
+        next_batch = batch
+    yield next_batch
 
 
 def _cross_entropy_loss_and_accuracy(logits, tokens, mask=None):
@@ -63,23 +147,31 @@ def _cross_entropy_loss_and_accuracy(logits, tokens, mask=None):
         mask = jnp.ones(tokens.shape[:2])
     mask = mask.astype(jnp.float32)
 
-    valid_text_length = jnp.maximum(jnp.sum(mask, axis=-1), 1e-10)
-
-    logits = logits.astype(jnp.float32)  # for numerical stability
-    token_log_prob = jnp.squeeze(
-        jnp.take_along_axis(
-            jax.nn.log_softmax(logits, axis=-1),
-            jnp.expand_dims(tokens, -1),
-            axis=-1,
-        ),
-        -1,
+    # Keep logits in their native dtype; accumulate exp/log in fp32.
+    logits_max = jax.lax.stop_gradient(
+        jnp.max(logits, axis=-1, keepdims=True)
+    )
+    lse = jnp.squeeze(logits_max, -1).astype(jnp.float32) + jnp.log(
+        jnp.sum(
+            jnp.exp((logits - logits_max).astype(jnp.float32)), axis=-1
+        )
     )
+    # One-hot contraction, not take_along_axis: fuses with the logsumexp
+    # reduction where a gather would not.
+    correct_logit = jnp.sum(
+        logits
+        * jax.nn.one_hot(tokens, logits.shape[-1], dtype=logits.dtype),
+        axis=-1,
+    )
+    token_log_prob = correct_logit - lse
+    # Token-weighted: one global reduction over all valid tokens.
+    total_valid = jnp.maximum(jnp.sum(mask), 1.0)
     token_log_prob = jnp.where(mask > 0.0, token_log_prob, jnp.array(0.0))
-    loss = -jnp.mean(jnp.sum(token_log_prob, axis=-1) / valid_text_length)
+    loss = -jnp.sum(token_log_prob) / total_valid
     correct = jnp.where(
         mask > 0.0, jnp.argmax(logits, axis=-1) == tokens, jnp.array(False)
     )
-    accuracy = jnp.mean(jnp.sum(correct, axis=-1) / valid_text_length)
+    accuracy = jnp.sum(correct) / total_valid
     return loss, accuracy
 
 
@@ -90,14 +182,21 @@ class TrainerConfig:
 
     # Model configuration
     model_name: str = "meta-llama/Llama-3.2-1B"
-    param_dtype: str = "float32"
+    # fp32 master weights; forward/backward computes in param_dtype.
+    param_dtype: str = "bfloat16"
     output_dtype: str = "float32"
 
     # Training configuration
     num_epochs: int = 1
     num_steps: int = 5
     num_tpus: int = jax.device_count()
-    
+    # Microbatches accumulated per optimizer update.
+    grad_accum_steps: int = 1
+    # Steps between checkpoint saves (when a checkpointer is configured).
+    checkpoint_interval: int = 10
+    # Steps between metric prints; losses stay on device in between.
+    log_interval: int = 10
+
     # Environment configuration
     base_dir: str = "/mnt/persistent-disk"
 
@@ -120,28 +219,81 @@ class Trainer:
         self.val_dataloader = val_dataloader
         self.mesh = mesh if mesh else get_mesh(trainer_config.num_tpus)
         self.checkpointer = checkpointer
+        self.param_dtype = jnp.dtype(trainer_config.param_dtype)
+
+        # Built once; JAX's device_put/jit caches key on sharding identity.
+        self._batch_sharding = NamedSharding(self.mesh, PS("batch"))
 
         self.model, self.model_config = load_model(
             model_name=trainer_config.model_name,
         )
         self.configure_optimizers()
 
+        # Built once rather than per step.
+        self._grad_fn = jax.value_and_grad(
+            self.forward, argnums=0, has_aux=True
+        )
+
+    # (model_params, model_static) is the canonical representation; the
+    # combined module is only materialized on demand.
+    @property
+    def model(self):
+        return eqx.combine(self.model_params, self.model_static)
+
+    @model.setter
+    def model(self, model):
+        self.model_params, self.model_static = eqx.partition(
+            model, eqx.is_array
+        )
+
     def configure_optimizers(self):
-        self.optimizer = optax.sgd(learning_rate=1e-3)
-        self.opt_state = self.optimizer.init(
-            eqx.filter(self.model, eqx.is_array)
+        self.learning_rate = 1e-3
+        # Constant-lr SGD needs no optax state; optax stays for schedules.
+        self._constant_lr = (
+            self.learning_rate
+            if isinstance(self.learning_rate, (int, float))
+            else None
         )
+        if self._constant_lr is not None:
+            self.optimizer = None
+            self.opt_state = ()
+            return
+        self.optimizer = optax.sgd(learning_rate=self.learning_rate)
+        self.opt_state = self.optimizer.init(self.model_params)
 
-    # TODO: Add microbatching (nando ref).
     @functools.partial(jax.jit, static_argnames=("self", "model_static"))
     def forward(self, model_params, model_static, batch):
         """Computes loss for a single forward and backward pass."""
+        # fp32 master weights; compute reads a param_dtype copy and grads
+        # flow back through the cast as fp32.
+        if self.param_dtype != jnp.float32:
+
+            def _cast(path, x):
+                # RoPE frequency tables stay fp32: bf16 rounding turns
+                # into radians-scale phase errors at large positions.
+                if not eqx.is_inexact_array(x) or "inv_freq" in (
+                    jax.tree_util.keystr(path)
+                ):
+                    return x
+                return x.astype(self.param_dtype)
+
+            model_params = jax.tree_util.tree_map_with_path(
+                _cast, model_params
+            )
         model = eqx.combine(model_params, model_static)
 
-        input_ids = batch["input_ids"]
-        labels = batch["labels"]
+        input_ids = batch["input_ids"].astype(jnp.int32)
+        labels = batch["labels"].astype(jnp.int32)
         attention_mask = batch.get("attention_mask", None)
         position_ids = batch.get("position_ids", None)
+        if position_ids is None:
+            # A sharded iota: no host allocation, no transfer.
+            position_ids = jax.lax.broadcasted_iota(
+                jnp.int32, input_ids.shape, 1
+            )
+            position_ids = jax.lax.with_sharding_constraint(
+                position_ids, NamedSharding(self.mesh, PS("batch", None))
+            )
 
         logits = model(input_ids, attention_mask, position_ids)
 
@@ -159,19 +311,79 @@ class Trainer:
         )
         return loss, accuracy
 
+    # Donation lets XLA update the param/opt-state buffers in place.
+    @functools.partial(
+        jax.jit,
+        static_argnames=("self", "model_static", "optimizer"),
+        donate_argnames=("model_params", "optimizer_state"),
+    )
     def training_step(
         self, model_params, model_static, optimizer, optimizer_state, batch
     ):
-        grad_fn = jax.value_and_grad(self.forward, argnums=(0), has_aux=True)
-        (loss, accuracy), grads = grad_fn(
-            model_params,
-            model_static=model_static,
-            batch=batch,
-        )
-        updates, optimizer_state = optimizer.update(
-            grads, optimizer_state, model_params
+        # Guarantee the opt-state sharding inside the compiled step.
+        optimizer_state = jax.lax.with_sharding_constraint(
+            optimizer_state,
+            _optimizer_state_sharding(optimizer_state, self.mesh),
         )
-        model_params = optax.apply_updates(model_params, updates)
+        accum_steps = self.trainer_config.grad_accum_steps
+        if accum_steps > 1:
+            # Shapes are static under jit, so this raises at trace time.
+            batch_size = jax.tree_util.tree_leaves(batch)[0].shape[0]
+            if batch_size % accum_steps != 0:
+                raise ValueError(
+                    f"Batch size {batch_size} is not divisible by "
+                    f"grad_accum_steps {accum_steps}"
+                )
+            # Scan over microbatches, summing grads in the carry; the
+            # all-reduce only fires on the combined grads.
+            micro_batches = jax.tree_util.tree_map(
+                lambda x: x.reshape(
+                    accum_steps, x.shape[0] // accum_steps, *x.shape[1:]
+                ),
+                batch,
+            )
+
+            def _accumulate(carry, micro_batch):
+                loss_sum, accuracy_sum, grads_sum = carry
+                (loss, accuracy), grads = self._grad_fn(
+                    model_params,
+                    model_static=model_static,
+                    batch=micro_batch,
+                )
+                carry = (
+                    loss_sum + loss,
+                    accuracy_sum + accuracy,
+                    jax.tree_util.tree_map(jnp.add, grads_sum, grads),
+                )
+                return carry, None
+
+            zero_grads = jax.tree_util.tree_map(
+                jnp.zeros_like, model_params
+            )
+            (loss, accuracy, grads), _ = jax.lax.scan(
+                _accumulate,
+                (jnp.zeros(()), jnp.zeros(()), zero_grads),
+                micro_batches,
+            )
+            loss, accuracy, grads = jax.tree_util.tree_map(
+                lambda x: x / accum_steps, (loss, accuracy, grads)
+            )
+        else:
+            (loss, accuracy), grads = self._grad_fn(
+                model_params,
+                model_static=model_static,
+                batch=batch,
+            )
+        if self._constant_lr is not None:
+            # One fused p - lr * g pass over the donated buffers.
+            model_params = jax.tree_util.tree_map(
+                lambda p, g: p - self._constant_lr * g, model_params, grads
+            )
+        else:
+            updates, optimizer_state = optimizer.update(
+                grads, optimizer_state, model_params
+            )
+            model_params = optax.apply_updates(model_params, updates)
         return loss, (accuracy, model_params, optimizer_state)
 
     def validation_step(
@@ -179,67 +391,125 @@ class Trainer:
     ):
         pass
 
+    def _compile_training_step(
+        self, model_params, model_static, opt_state, batch
+    ):
+        """AOT-compiles training_step against a real batch's specs.
+
+        Statics (self, model_static, optimizer) are baked in; call the
+        result with (model_params, optimizer_state, batch).
+        """
+        batch_specs = jax.tree_util.tree_map(
+            lambda x: jax.ShapeDtypeStruct(
+                x.shape, x.dtype, sharding=x.sharding
+            ),
+            batch,
+        )
+        return (
+            type(self)
+            .training_step.lower(
+                self,
+                model_params,
+                model_static,
+                self.optimizer,
+                opt_state,
+                batch_specs,
+            )
+            .compile()
+        )
+
+    def _log_metrics(self, step_metrics):
+        """Prints accumulated step metrics with one batched D2H copy."""
+        for logged_step, loss, accuracy in jax.device_get(step_metrics):
+            print(
+                f"Step {logged_step}: Loss: {loss:.4f}, Accuracy: {accuracy:.4f}"
+            )
+
     def train(self):
-        model_params, model_static = eqx.partition(self.model, eqx.is_array)
-        optimizer_state = self.opt_state
+        model_params, model_static = self.model_params, self.model_static
+        # Placed once; the state keeps its sharding across steps.
+        optimizer_state = jax.device_put(
+            self.opt_state,
+            _optimizer_state_sharding(self.opt_state, self.mesh),
+        )
         max_steps = self.trainer_config.num_steps or float("inf")
 
-        prev_step = 0
-        prev_loss = 0.0
-        prev_accuracy = 0.0
+        batch_iterator = _one_batch_ahead_iterator(
+            self.train_dataloader, self._batch_sharding
+        )
+
+        # Compile against the shapes the dataloader actually yields.
+        first_batch = next(batch_iterator, None)
+        if first_batch is None:
+            raise ValueError("train_dataloader yielded no batches")
+        train_step = self._compile_training_step(
+            model_params, model_static, optimizer_state, first_batch
+        )
+
+        # Device futures; fetching per step would stall the dispatch queue.
+        step_metrics = []
 
-        for step, batch in enumerate(self.train_dataloader):
+        for step, batch in enumerate(
+            itertools.chain([first_batch], batch_iterator)
+        ):
             if step >= max_steps:
                 break
 
-            if step:
-                # Printing metrics of previous step, so that XLA pipelining is not disrupted.
-                print(
-                    f"Step {prev_step}: Loss: {prev_loss:.4f}, Accuracy: {prev_accuracy:.4f}"
+            try:
+                loss, (accuracy, model_params, optimizer_state) = train_step(
+                    model_params, optimizer_state, batch
+                )
+            except TypeError:
+                # Shape or key drift (e.g. a trailing partial batch):
+                # the jitted step retraces where the AOT executable errors.
+                loss, (accuracy, model_params, optimizer_state) = (
+                    self.training_step(
+                        model_params=model_params,
+                        model_static=model_static,
+                        optimizer=self.optimizer,
+                        optimizer_state=optimizer_state,
+                        batch=batch,
+                    )
                 )
 
-            batch = _preprocess_batch(batch)
-            batch = jax.device_put(batch, NamedSharding(self.mesh, PS("batch")))
-            optimizer_state = jax.device_put(
-                optimizer_state, NamedSharding(self.mesh, PS())
-            )
-
-            loss, (accuracy, model_params, optimizer_state) = self.training_step(
-                model_params=model_params,
-                model_static=model_static,
-                optimizer=self.optimizer,
-                optimizer_state=optimizer_state,
-                batch=batch,
-            )
-
-            prev_step = step + 1
-            prev_loss = loss
-            prev_accuracy = accuracy
+            step_metrics.append((step + 1, loss, accuracy))
+            if (step + 1) % self.trainer_config.log_interval == 0:
+                self._log_metrics(step_metrics)
+                step_metrics = []
 
-            if self.checkpointer:
+            # Touch the parameter PyTree only at checkpoint boundaries.
+            if (
+                self.checkpointer
+                and (step + 1) % self.trainer_config.checkpoint_interval == 0
+            ):
                 self.checkpointer.save_checkpoint(
-                    model=eqx.combine(model_params, model_static),
+                    model_params=model_params,
+                    model_static=model_static,
                     model_config=self.model_config,
                     step=step + 1,
                 )
 
+        if step_metrics:
+            self._log_metrics(step_metrics)
+
         # Save final checkpoint
         if self.checkpointer:
             self.checkpointer.save_checkpoint(
-                model=eqx.combine(model_params, model_static),
+                model_params=model_params,
+                model_static=model_static,
                 model_config=self.model_config,
                 step=step + 1,
             )
             self.checkpointer.wait_until_finished()
             print("Final checkpoint saved at:", self.checkpointer.checkpoint_dir)
 
-        self.model = eqx.combine(model_params, model_static)
+        self.model_params = model_params
         print("Training completed!")
 
         # After training, convert and save the model in Hugging Face format
         export_dir = os.path.join(self.trainer_config.base_dir, "hf_export")
         save_model_to_hf(
-            model=self.model,
+            model=self.model,  # Combined once here, at export time.
             model_config=self.model_config,
             output_dir=export_dir,
             tokenizer_name=self.trainer_config.model_name,  # Use the same tokenizer as the original model
@@ -87,6 +87,7 @@ class AlpacaDataset(BaseDataset):
             shuffle=True,
             generator=torch.Generator().manual_seed(self.config.seed),
             num_workers=self.config.num_workers,
+            pin_memory=self.config.pin_memory,
             collate_fn=get_sft_collate_fn(
                 max_seq_length=self.config.max_seq_length,
                 pad_id=self.config.pad_id,
@@ -100,6 +101,7 @@ class AlpacaDataset(BaseDataset):
             batch_size=self.config.batch_size,
             shuffle=False,
             num_workers=self.config.num_workers,
+            pin_memory=self.config.pin_memory,
             collate_fn=get_sft_collate_fn(
                 max_seq_length=self.config.max_seq_length,
                 pad_id=self.config.pad_id,
@@ -0,0 +1,93 @@
+import jax
+import jax.numpy as jnp
+
+from felafax.trainer_engine.trainer import _cross_entropy_loss_and_accuracy
+
+
+def _reference_loss_and_accuracy(logits, tokens, mask):
+    """Baseline log_softmax/take_along_axis formulation, token-weighted."""
+    mask = mask.astype(jnp.float32)
+    logits = logits.astype(jnp.float32)
+    token_log_prob = jnp.squeeze(
+        jnp.take_along_axis(
+            jax.nn.log_softmax(logits, axis=-1),
+            jnp.expand_dims(tokens, -1),
+            axis=-1,
+        ),
+        -1,
+    )
+    total_valid = jnp.maximum(jnp.sum(mask), 1.0)
+    loss = -jnp.sum(jnp.where(mask > 0.0, token_log_prob, 0.0)) / total_valid
+    correct = jnp.where(
+        mask > 0.0, jnp.argmax(logits, axis=-1) == tokens, False
+    )
+    accuracy = jnp.sum(correct) / total_valid
+    return loss, accuracy
+
+
+def _random_inputs(batch_size=2, seq_length=8, vocab_size=16):
+    logits = (
+        jax.random.normal(
+            jax.random.PRNGKey(0),
+            (batch_size, seq_length, vocab_size),
+            dtype=jnp.float32,
+        )
+        * 5.0
+    )
+    tokens = jax.random.randint(
+        jax.random.PRNGKey(1), (batch_size, seq_length), 0, vocab_size
+    )
+    return logits, tokens
+
+
+def test_matches_log_softmax_formulation():
+    """The fused logsumexp/one-hot path matches the naive formulation."""
+    logits, tokens = _random_inputs()
+    mask = jnp.ones(tokens.shape)
+
+    loss, accuracy = _cross_entropy_loss_and_accuracy(logits, tokens, mask)
+    ref_loss, ref_accuracy = _reference_loss_and_accuracy(
+        logits, tokens, mask
+    )
+
+    assert jnp.allclose(loss, ref_loss, atol=1e-5)
+    assert jnp.allclose(accuracy, ref_accuracy)
+
+
+def test_no_mask_defaults_to_all_valid():
+    logits, tokens = _random_inputs()
+
+    loss, accuracy = _cross_entropy_loss_and_accuracy(logits, tokens)
+    ref_loss, ref_accuracy = _cross_entropy_loss_and_accuracy(
+        logits, tokens, jnp.ones(tokens.shape)
+    )
+
+    assert jnp.allclose(loss, ref_loss)
+    assert jnp.allclose(accuracy, ref_accuracy)
+
+
+def test_token_weighted_with_ragged_mask():
+    """With ragged masks each valid token carries equal weight."""
+    logits, tokens = _random_inputs()
+    mask = jnp.array(
+        [
+            [1, 1, 1, 1, 1, 1, 0, 0],
+            [1, 1, 0, 0, 0, 0, 0, 0],
+        ]
+    )
+
+    loss, accuracy = _cross_entropy_loss_and_accuracy(logits, tokens, mask)
+    ref_loss, ref_accuracy = _reference_loss_and_accuracy(
+        logits, tokens, mask
+    )
+
+    assert jnp.allclose(loss, ref_loss, atol=1e-5)
+    assert jnp.allclose(accuracy, ref_accuracy)
+
+    # Masked positions must not contribute: corrupting them changes
+    # nothing.
+    corrupted = jnp.where(mask[..., None] > 0.0, logits, 1e4)
+    corrupted_loss, _ = _cross_entropy_loss_and_accuracy(
+        corrupted, tokens, mask
+    )
+    assert jnp.allclose(loss, corrupted_loss, atol=1e-5)